@@ -1,25 +1,85 @@
 """Functions for loading and parsing MOSAiC GEM-2 and Magnaprobe datasets"""
 
+from fnmatch import fnmatch
+from functools import lru_cache
+import os
 from pathlib import Path
+import warnings
 
 import pandas as pd
 import numpy as np
 
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
 DATAPATH = Path.home() / 'Data' / 'Sunlight_under_seaice'
 GEM2_PATH = DATAPATH / 'MOSAiC_GEM2_icethickness' / '01-ice-thickness'
 MAGNAPROBE_PATH = DATAPATH / 'MOSAiC_magnaprobe'
 
+# Column types for combined transect files, passed to read_csv so pandas
+# does not have to infer them.  Depths and thicknesses are only measured to
+# the cm so are stored as float32; positions are kept as float64.
+COMBINED_DTYPES = {
+    ' Lon': 'float64',
+    ' Lat': 'float64',
+    ' Local X': 'float64',
+    ' Local Y': 'float64',
+    ' Snow Depth (m)': 'float32',
+    ' Melt Pond Depth (m)': 'float32',
+    ' Ice Thickness 18kHz ip (m)': 'float32',
+    ' Ice Thickness 5kHz ip (m)': 'float32',
+    ' Ice Thickness 93kHz ip (m)': 'float32',
+}
+
+# Names given to the columns read from combined transect files
+COLUMN_NAMES = {
+    ' Lon': 'lon',
+    ' Lat': 'lat',
+    ' Local X': 'local_x',
+    ' Local Y': 'local_y',
+    ' Snow Depth (m)': 'snow_depth_m',
+    ' Melt Pond Depth (m)': 'melt_pond_depth_m',
+    ' Surface Type': 'surface_type',
+    ' Ice Thickness 18kHz ip (m)': 'ice_thickness_18khz_ip_m',
+    ' Ice Thickness 5kHz ip (m)': 'ice_thickness_5khz_ip_m',
+    ' Ice Thickness 93kHz ip (m)': 'ice_thickness_93khz_ip_m',
+}
+
+
+@lru_cache(maxsize=None)
+def _list_dir(path):
+    """Returns a cached listing of the entry names in a directory.  Call
+    _list_dir.cache_clear() if files are added or removed during a session"""
+    with os.scandir(path) as entries:
+        return tuple(entry.name for entry in entries)
+
+
+def _glob(path, pattern):
+    """Returns entries of path matching a glob pattern using the cached listing"""
+    return [path / name for name in _list_dir(path) if fnmatch(name, pattern)]
+
 
 def icethickness_file(dsid):
     """Returns a file from a MOSAiC dataset id"""
-    return next(next(GEM2_PATH.glob("*"+dsid.replace('/','-'))).glob('*channel-thickness.csv'))
+    dirlist = _glob(GEM2_PATH, "*"+dsid.replace('/','-'))
+    if not dirlist:
+        raise NotADirectoryError(f"No directory found for {dsid}")
+    dirpath = dirlist[0]
+    filelist = _glob(dirpath, '*channel-thickness.csv')
+    if not filelist:
+        raise FileNotFoundError(f"No *channel-thickness.csv file in {str(dirpath)}")
+    return filelist[0]
 
 
 def snowdepth_file(dsid):
     """Returns a snow depth file from a MOSAiC dataset id"""
-    thispath = MAGNAPROBE_PATH.match("*"+dsid.replace("/","-"))
-    if thispath:
-        filelist = list(thispath.glob("magna+gem2*.csv"))
+    dirlist = _glob(MAGNAPROBE_PATH, "*"+dsid.replace("/","-"))
+    if dirlist:
+        thispath = dirlist[0]
+        filelist = _glob(thispath, "magna+gem2*.csv")
         if len(filelist) == 0:
             raise FileNotFoundError(f"No magna+gem2*.csv file in {str(thispath)}")
         elif len(filelist) > 1:
@@ -36,15 +96,17 @@ def transect_distance(x0, y0):
     :x0: x in local cordinates
     :y0: y in local coordinates
     """
-    x0 = np.array(x0)
-    y0 = np.array(y0)
-    x1, y1 = np.roll(x0, 1), np.roll(y0, 1)
-    x1[0], y1[0] = x1[1], y1[1]
-    return np.cumsum(np.sqrt((x1 - x0)**2 + (y1 - y0)**2))
+    x0 = np.asarray(x0, dtype=np.float64)
+    y0 = np.asarray(y0, dtype=np.float64)
+    distance = np.empty_like(x0)
+    distance[:1] = 0.
+    np.hypot(np.diff(x0), np.diff(y0), out=distance[1:])
+    np.cumsum(distance, out=distance)
+    return distance
 
 
 def get_filename(fp, type='combined'):
-    filelist = list(fp.glob("magna+gem2*.csv"))
+    filelist = _glob(fp, "magna+gem2*.csv")
     if len(filelist) == 0:
         raise FileNotFoundError(f"No magna+gem2*.csv file in {str(fp)}")
     elif len(filelist) > 1:
@@ -53,17 +115,81 @@ def get_filename(fp, type='combined'):
         return filelist[0]
     
     
-def load_data(fp):
-    """Loads a combined snowdepth and ice thickness transect"""
-    usecols = ['Date/Time', ' Lon', ' Lat', ' Local X', ' Local Y', ' Snow Depth (m)',
-       ' Melt Pond Depth (m)', ' Surface Type', ' Ice Thickness 18kHz ip (m)',
-       ' Ice Thickness 5kHz ip (m)', ' Ice Thickness 93kHz ip (m)']
-    df = pd.read_csv(fp, usecols=usecols, parse_dates=True, index_col=0)
-    df.columns = ['_'.join(s.strip().lower().replace('(','').replace(')','').split()) for s in df.columns]
-    df['ice_thickness_mean_m'] = df[['ice_thickness_18khz_ip_m', 'ice_thickness_5khz_ip_m', 'ice_thickness_93khz_ip_m']].mean(axis=1)
-    df['melt_pond_depth_m'] = df['melt_pond_depth_m'].where(df['melt_pond_depth_m'] > 0., 0.)
-    df['snow_depth_m'] = df['snow_depth_m'].where(df['snow_depth_m'] > 0., 0.)
+def _process_data(df):
+    """Renames the columns of a raw combined transect, clamps depths and adds
+    the mean ice thickness.  transect_distance_m is added by the caller."""
+    df.index = df.index.astype('datetime64[ns]')
+    df = df.rename(columns=COLUMN_NAMES)
+    ice_thickness = df[['ice_thickness_18khz_ip_m', 'ice_thickness_5khz_ip_m', 'ice_thickness_93khz_ip_m']].to_numpy()
+    with warnings.catch_warnings():
+        # Points with no valid thickness are left as NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        df['ice_thickness_mean_m'] = np.nanmean(ice_thickness, axis=1)
+    # fmax rather than maximum so that missing depths are also set to zero
+    depth_columns = ['melt_pond_depth_m', 'snow_depth_m']
+    df[depth_columns] = np.fmax(df[depth_columns].to_numpy(), 0.)
+    return df
+
+
+def load_data(fp, cache=False):
+    """Loads a combined snowdepth and ice thickness transect
+
+    :fp: path to combined transect file
+    :cache: if True, the parsed transect is saved to a parquet file next to fp
+            and reloaded from there while it is newer than fp
+    """
+    fp = Path(fp)
+    cachefile = fp.with_suffix('.parquet')
+    if cache and cachefile.exists() and cachefile.stat().st_mtime >= fp.stat().st_mtime:
+        return pd.read_parquet(cachefile)
+
+    usecols = ['Date/Time', *COLUMN_NAMES]
+    df = pd.read_csv(fp, usecols=usecols, dtype=COMBINED_DTYPES, parse_dates=True, index_col=0,
+                     engine=CSV_ENGINE)
+    df = _process_data(df)
     df['transect_distance_m'] = transect_distance(df.local_x.values, df.local_y.values)
+    if cache:
+        df.to_parquet(cachefile)
     return df
 
 
+def iter_data(fp, chunksize=100_000):
+    """Loads a combined snowdepth and ice thickness transect in chunks, yielding
+    a pandas.DataFrame for each chunk in the same format as load_data.  Use for
+    very large files so that only one chunk is held in memory at a time.
+
+    transect_distance_m continues from the end of the previous chunk, so the
+    chunks concatenate to the same values as load_data, up to rounding in the
+    cumulative distance.
+
+    :fp: path to combined transect file
+    :chunksize: number of rows in each chunk
+    """
+    usecols = ['Date/Time', *COLUMN_NAMES]
+    # pyarrow does not support chunksize.  round_trip makes the C parser
+    # read floats to the same values as the pyarrow parser used by load_data
+    reader = pd.read_csv(fp, usecols=usecols, dtype=COMBINED_DTYPES, parse_dates=True, index_col=0,
+                         chunksize=chunksize, float_precision='round_trip')
+    last = None  # (x, y, distance) of the last point of the previous chunk
+    with reader:
+        for df in reader:
+            df = _process_data(df)
+            x = df.local_x.values
+            y = df.local_y.values
+            distance = transect_distance(x, y)
+            if last is not None and len(distance):
+                distance += last[2] + np.hypot(x[0] - last[0], y[0] - last[1])
+            if len(distance):
+                last = (x[-1], y[-1], distance[-1])
+            df['transect_distance_m'] = distance
+            yield df
+
+
+def __getattr__(name):
+    """plot_thickness_profile is defined in plotting and re-exported here for
+    existing imports.  It is imported on first access so that loading data
+    does not import the plotting module."""
+    if name == 'plot_thickness_profile':
+        from plotting import plot_thickness_profile
+        return plot_thickness_profile
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
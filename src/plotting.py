@@ -1,8 +1,12 @@
-"""Functions for plotting"""
+"""Functions for plotting
+
+matplotlib.pyplot is imported inside the functions that create figures so
+that importing this module does not initialise matplotlib
+"""
 import numpy as np
-import matplotlib.pyplot as plt
 
 def plot_results(df):
+    import matplotlib.pyplot as plt
 
     distance = df.index.values
     sw_absorbed_by_ocean = df.sw_absorbed_by_ocean
@@ -43,19 +47,25 @@ def plot_results(df):
 
 def plot_thickness_profile(df, ax=None, snow_depth_exaggeration=2):
     """Plots a thickness profile from GEM-2 and Magnaprobe data"""
-    snow_ice_interface = np.zeros(len(df.snow_depth_m))
-    snow_surface = snow_ice_interface + (df.snow_depth_m.where(df.snow_depth_m > 0.) * snow_depth_exaggeration)
-    ice_ocean_interface = snow_ice_interface - df.ice_thickness_mean_m
-    pond_depth = snow_ice_interface - df.melt_pond_depth_m.where(df.melt_pond_depth_m > 0.)
-    distance = df.transect_distance_m.values
+    if len(df) == 0:
+        return
+
+    snow_depth = df.snow_depth_m.to_numpy()
+    melt_pond_depth = df.melt_pond_depth_m.to_numpy()
+    distance = df.transect_distance_m.to_numpy()
+
+    snow_ice_interface = np.zeros(len(snow_depth))
+    snow_surface = np.where(snow_depth > 0., snow_depth * snow_depth_exaggeration, np.nan)
+    ice_ocean_interface = -df.ice_thickness_mean_m.to_numpy()
+    pond_depth = np.where(melt_pond_depth > 0., -melt_pond_depth, np.nan)
     ax.set_xlim(distance[0], distance[-1])
     ax.fill_between(distance, snow_surface, snow_ice_interface, color='0.7')
     ax.fill_between(distance, snow_ice_interface, ice_ocean_interface, color='lightblue')
     ax.fill_between(distance, snow_ice_interface, pond_depth, color='blue')
     
     # Kluge fix for labels
-    ymin = np.floor(ice_ocean_interface.min() / 0.5) * 0.5
-    ymax = np.ceil(snow_surface.max() / 0.5) * 0.5
+    ymin = np.floor(np.nanmin(ice_ocean_interface) / 0.5) * 0.5
+    ymax = np.ceil(np.nanmax(snow_surface) / 0.5) * 0.5
     ax.set_ylim(ymin, ymax)
 
     ax.set_xlabel("Transect distance (m)")
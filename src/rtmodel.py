@@ -1,61 +1,163 @@
 """Contains functions to run seaice_rt model"""
+from multiprocessing import Pool
+import os
+
+import numpy as np
 import pandas as pd
 
 from seaicert.ccsm3_sir_de import SeaIceRT
 
+from mosaic_thickness import iter_data
 
-def seaicert_mp(df):
-    """Runs the SeaIceRT model for multiple points.  Output is returned as a pandas.DataFrame"""
-    
-    model = SeaIceRT()
+# Model inputs are rounded to these number of decimal places before running
+# the model, so that points with effectively the same inputs share one run
+LATITUDE_DECIMALS = 2
+DEPTH_DECIMALS = 3
+
+# Model instance shared by all runs in a process, created by _get_model
+_MODEL = None
+
+
+def _get_model():
+    """Returns the SeaIceRT instance for this process, creating it on first use"""
+    global _MODEL
+    if _MODEL is None:
+        _MODEL = SeaIceRT()
+        _MODEL.snow_grain_radius = 180.
+    return _MODEL
+
+
+def _run_model(model, day_of_year, latitude, snow_depth, pond_depth, sea_ice_thickness):
+    """Runs the model for one point and returns the outputs used by seaicert_mp"""
+    model.day_of_year = day_of_year
+    model.latitude = latitude
+    model.snow_depth = snow_depth
+    model.pond_depth = pond_depth
+    model.sea_ice_thickness = sea_ice_thickness
+
+    model.run()
+    output = model.get_results()
+    return (
+        output["downwelling_shortwave_flux_absorbed_by_ocean"],
+        output["surface_albedo"],
+        output["surface_downwelling_radiative_flux"],
+    )
+
+
+def _run_worker(point):
+    """Runs the model for one point in a worker process"""
+    return _run_model(_get_model(), *point)
+
+
+def _make_pool(processes):
+    """Returns a Pool of worker processes that each hold a SeaIceRT instance,
+    and the number of workers in it"""
+    nworkers = processes or os.cpu_count()
+    return Pool(processes=nworkers, initializer=_get_model), nworkers
 
-    model.snow_grain_radius = 180.
 
-    day_of_year = df.index.day_of_year
+def seaicert_mp(df, processes=1):
+    """Runs the SeaIceRT model for multiple points.  Output is returned as a pandas.DataFrame
+
+    :df: pandas.DataFrame of transect points returned by mosaic_thickness.load_data
+    :processes: number of worker processes to run the model in.  Default 1 runs
+                the model in the calling process.  None uses all available cores.
+    """
+    if processes == 1:
+        return _seaicert(df)
+    pool, nworkers = _make_pool(processes)
+    with pool:
+        return _seaicert(df, pool, nworkers)
+
+
+def _seaicert(df, pool=None, nworkers=1):
+    """Runs the SeaIceRT model for the points in df, in pool if one is given,
+    otherwise in the calling process"""
+    day_of_year = df.index.day_of_year.to_numpy() + 0.5  # adjust for longitude?
     lat = df.lat.values
+    transect_distance_m = df.transect_distance_m.values
     snow_depth_m = df.snow_depth_m.values
     melt_pond_depth_m = df.melt_pond_depth_m.values
     ice_thickness_mean_m = df.ice_thickness_mean_m.values
     
-    thiszip = zip(
+    # Neighbouring points often have near-identical inputs, so the model is
+    # only run once for each unique set of rounded inputs
+    inputs = np.column_stack([
         day_of_year,
-        lat,
-        snow_depth_m,
-        melt_pond_depth_m,
-        ice_thickness_mean_m,
-    )
-    
-    distance = []
-    sw_absorbed_by_ocean = []
-    surface_albedo = []
-    surface_downwelling_radiative_flux = []
-    #for idx, vals in df.iterrows():
-    for iday_of_year, ilat, isnow_depth_m, imelt_pond_depth_m, iice_thickness_mean_m in thiszip:
-        model.day_of_year = iday_of_year + 0.5  # adjust for longitude?
-        model.latitude = ilat
-        model.snow_depth = isnow_depth_m
-        model.pond_depth = imelt_pond_depth_m
-        model.sea_ice_thickness = iice_thickness_mean_m
-    
-        model.run()
-        output = model.get_results()
-        #distance.append(vals.transect_distance_m)
-        sw_absorbed_by_ocean.append(output["downwelling_shortwave_flux_absorbed_by_ocean"])
-        surface_albedo.append(output["surface_albedo"])
-        surface_downwelling_radiative_flux.append(output["surface_downwelling_radiative_flux"])
-        
+        np.round(lat, LATITUDE_DECIMALS),
+        np.round(snow_depth_m.astype(np.float64), DEPTH_DECIMALS),
+        np.round(melt_pond_depth_m.astype(np.float64), DEPTH_DECIMALS),
+        np.round(ice_thickness_mean_m.astype(np.float64), DEPTH_DECIMALS),
+    ])
+    # Points with missing inputs are not run and get NaN outputs
+    valid = np.isfinite(inputs).all(axis=1)
+    unique_inputs, inverse = np.unique(inputs[valid], axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    unique_inputs = unique_inputs.tolist()
+
+    results = np.empty((3, len(unique_inputs)), dtype=np.float32)
+    if pool is None:
+        model = _get_model()
+        for i, point in enumerate(unique_inputs):
+            results[:, i] = _run_model(model, *point)
+    else:
+        chunksize = max(1, len(unique_inputs) // (4 * nworkers))
+        for i, output in enumerate(pool.imap(_run_worker, unique_inputs, chunksize=chunksize)):
+            results[:, i] = output
+    outputs = np.full((3, len(df)), np.nan, dtype=np.float32)
+    outputs[:, valid] = results[:, inverse]
+    sw_absorbed_by_ocean, surface_albedo, surface_downwelling_radiative_flux = outputs
+
+    # Input columns are copied so the result does not share memory with df;
+    # the freshly allocated output rows are used without copying
     result = pd.DataFrame(
         {
-            'datetime': df.index.values,
-            'latitude': df.lat.values,
-            'snow_depth_m': df.snow_depth_m.values,
-            'melt_pond_depth_m': df.melt_pond_depth_m.values,
-            'ice_thickness_mean_m': df.ice_thickness_mean_m.values,
+            'datetime': df.index.values.copy(),
+            'latitude': lat.copy(),
+            'snow_depth_m': snow_depth_m.copy(),
+            'melt_pond_depth_m': melt_pond_depth_m.copy(),
+            'ice_thickness_mean_m': ice_thickness_mean_m.copy(),
             'sw_absorbed_by_ocean': sw_absorbed_by_ocean,
             'surface_albedo': surface_albedo,
             'surface_downwelling_radiative_flux': surface_downwelling_radiative_flux,
-            'transect_distance_m': df.transect_distance_m.values,
+            'transect_distance_m': transect_distance_m.copy(),
         },
         index = df.transect_distance_m,
+        copy=False,
     )
     return result
+
+
+def seaicert_chunks(df_iter, chunksize=100_000, processes=1):
+    """Runs the SeaIceRT model for successive chunks of points, yielding a
+    pandas.DataFrame of results for each chunk.  Use for very long transects so
+    that results can be written out as they are produced.
+
+    Passing the path to a combined transect file reads it with
+    mosaic_thickness.iter_data, so only one chunk of the transect is held in
+    memory at a time.  A DataFrame that is already loaded is split into
+    chunks, so only the results are streamed.
+
+    When processes is not 1, one Pool is used for all chunks so that worker
+    processes and their SeaIceRT instances are only created once.
+
+    :df_iter: path to a combined transect file, a pandas.DataFrame returned by
+              mosaic_thickness.load_data, or an iterable of DataFrames such as
+              those yielded by mosaic_thickness.iter_data
+    :chunksize: number of points in each chunk when df_iter is a path or a
+                DataFrame
+    :processes: number of worker processes, as for seaicert_mp
+    """
+    if isinstance(df_iter, (str, os.PathLike)):
+        df_iter = iter_data(df_iter, chunksize=chunksize)
+    elif isinstance(df_iter, pd.DataFrame):
+        df = df_iter
+        df_iter = (df.iloc[start:start + chunksize] for start in range(0, len(df), chunksize))
+    if processes == 1:
+        for chunk in df_iter:
+            yield _seaicert(chunk)
+        return
+    pool, nworkers = _make_pool(processes)
+    with pool:
+        for chunk in df_iter:
+            yield _seaicert(chunk, pool, nworkers)